@@ -1,8 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
 from google.oauth2.service_account import Credentials
+from gspread.utils import rowcol_to_a1
 import datetime
+import bisect
 import re
 import altair as alt
 import uuid
@@ -17,6 +20,11 @@ NEW_SHEET_NAME = 'database'
 # ジョブID列を含むヘッダー定義
 EXPECTED_HEADERS = ['シリアルナンバー', 'ステータス', '保有開始日', '完了日', 'エリア', '金額', '備考', 'ジョブID']
 ANALYTICS_CACHE_FILE = 'analytics_cache.json'
+DB_CACHE_TTL = 60  # シート読込キャッシュの有効秒数 (書込時は即時破棄)
+
+# --- 数量ボーナス (週の本数がしきい値以上で単価加算) ---
+VOL_BONUS_THRESHOLDS = (20, 50, 100, 150)
+VOL_BONUS_VALUES = (0, 5, 10, 15, 20)
 
 # --- エリア定義 ---
 ZONE_OPTIONS = [
@@ -32,20 +40,44 @@ ZONES = {
     "C: 指定都市(横浜等)": 60,
 }
 
+# --- テキスト解析パターン ---
+FULLWIDTH_DIGITS = str.maketrans('０１２３４５６７８９', '0123456789')
+DATE_PATTERN = re.compile(r'(\d{4})[-/.](\d{2})[-/.](\d{2})')
+SERIAL_PATTERN = re.compile(r'\b(\d{8})\b')
+
 # --- GCP設定 ---
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
 ]
 
+@st.cache_resource
+def _authorize_client():
+    # 認証済みクライアントはプロセス内で使い回す (再実行ごとのOAuthを回避)
+    creds_dict = st.secrets["gcp_service_account"]
+    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+    return gspread.authorize(creds)
+
 def get_connection():
     if "gcp_service_account" not in st.secrets:
         st.error("システムエラー: Secretsの設定が見つかりません。")
         return None
-    creds_dict = st.secrets["gcp_service_account"]
-    creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-    client = gspread.authorize(creds)
-    return client
+    return _authorize_client()
+
+@st.cache_resource
+def _open_sheet():
+    wb = _authorize_client().open('battery_db')
+    try:
+        sheet = wb.worksheet(NEW_SHEET_NAME)
+    except gspread.WorksheetNotFound:
+        sheet = wb.add_worksheet(title=NEW_SHEET_NAME, rows=1000, cols=10)
+    # ヘッダー行の確認はプロセスにつき1回だけ (書込のたびに row_values(1) を呼ばない)
+    if not sheet.row_values(1): sheet.append_row(EXPECTED_HEADERS)
+    return sheet
+
+def get_sheet():
+    if not get_connection(): return None
+    return _open_sheet()
 
 def get_today_jst():
     now = datetime.datetime.now() + datetime.timedelta(hours=9)
@@ -59,96 +91,173 @@ def sanitize_for_json(val):
     return str(val)
 
 # --- テキスト解析 ---
+# 入力欄の内容が同じ再実行では解析結果をそのまま返す
+@st.cache_data(max_entries=64, show_spinner=False)
 def extract_serials_with_date(text, default_date):
-    results = []
+    # シリアル -> 日付 (同一シリアルは後勝ち、並びは初出順)
+    results = {}
     default_date_str = default_date.strftime('%Y-%m-%d')
     if text:
-        text = text.translate(str.maketrans('０１２３４５６７８９', '0123456789'))
+        text = text.translate(FULLWIDTH_DIGITS)
     else: return []
-    
-    date_pattern = re.compile(r'(\d{4})[-/.](\d{2})[-/.](\d{2})')
-    serial_pattern = re.compile(r'\b(\d{8})\b')
+
+    # 日付を含まない貼付 (シリアルのみ) は行分割せず1回の走査で済ませる
+    if not DATE_PATTERN.search(text):
+        return [(s, default_date_str) for s in dict.fromkeys(SERIAL_PATTERN.findall(text))]
 
     lines = [line.strip() for line in text.split('\n') if line.strip()]
+
+    # 日付は各行1回だけ検索し、シリアル行からは当該行+後続3行の結果を参照する
+    line_dates = []
+    for line in lines:
+        d_match = DATE_PATTERN.search(line)
+        line_dates.append(f"{d_match.group(1)}-{d_match.group(2)}-{d_match.group(3)}" if d_match else None)
     
     for i, line in enumerate(lines):
-        serials_in_line = serial_pattern.findall(line)
+        serials_in_line = SERIAL_PATTERN.findall(line)
         if not serials_in_line: continue
         
-        search_window = lines[i : min(len(lines), i+4)]
-        found_date = default_date_str
-        for check_line in search_window:
-            d_match = date_pattern.search(check_line)
-            if d_match:
-                found_date = f"{d_match.group(1)}-{d_match.group(2)}-{d_match.group(3)}"
-                break
+        found_date = next((d for d in line_dates[i:i+4] if d), default_date_str)
         
         for s in serials_in_line:
-            results.append((s, found_date))
+            results[s] = found_date
             
     if not results:
-        all_serials = serial_pattern.findall(text)
-        all_dates = date_pattern.findall(text)
+        all_serials = SERIAL_PATTERN.findall(text)
+        all_dates = DATE_PATTERN.findall(text)
         if all_serials:
             backup_date = f"{all_dates[0][0]}-{all_dates[0][1]}-{all_dates[0][2]}" if all_dates else default_date_str
-            for s in all_serials: results.append((s, backup_date))
+            for s in all_serials: results[s] = backup_date
 
-    unique_map = {r[0]: r[1] for r in results}
-    return list(unique_map.items())
+    return list(results.items())
 
+@st.cache_data(max_entries=64, show_spinner=False)
 def extract_serials_only(text):
     if not text: return []
-    text = text.translate(str.maketrans('０１２３４５６７８９', '0123456789'))
-    return list(set(re.findall(r'\b\d{8}\b', text)))
+    text = text.translate(FULLWIDTH_DIGITS)
+    return list(dict.fromkeys(SERIAL_PATTERN.findall(text)))
 
 # --- データ取得 ---
+def _fetch_values():
+    # Sheets APIの全件取得はここだけ
+    # get_all_recordsの行ごとのdict生成を避け、2次元リストのまま受け取る
+    sheet = get_sheet()
+    values = sheet.get_all_values()
+    # カラム不足の補正
+    if values and 'ジョブID' not in values[0]:
+        sheet.update_cell(1, len(values[0]) + 1, 'ジョブID')
+        for row in values: row.append("")
+        values[0][-1] = 'ジョブID'
+    return values
+
+@st.cache_data(ttl=DB_CACHE_TTL, show_spinner=False)
+def _load_frame():
+    # 通信と型変換をまとめてキャッシュし、再実行ごとの表の組み立て直しを避ける
+    # 例外はキャッシュされないため、取得失敗は次の再実行で再試行される
+    values = _fetch_values()
+    if len(values) < 2: return pd.DataFrame(columns=EXPECTED_HEADERS)
+    df = pd.DataFrame(values[1:], columns=values[0])
+
+    df['シリアルナンバー'] = df['シリアルナンバー'].astype(str)
+    if 'ステータス' in df.columns:
+        df['ステータス'] = df['ステータス'].astype(str).str.strip()
+    
+    df['金額'] = pd.to_numeric(df['金額'], errors='coerce').fillna(0).astype(int)
+    # 備考は値の種類が少ないのでカテゴリ型で持つ (文字列判定はカテゴリ数だけで済む)
+    if '備考' in df.columns:
+        df['備考'] = df['備考'].astype('category')
+    for col in ['保有開始日', '完了日']:
+        if col in df.columns:
+            # 書込は常に '%Y-%m-%d' なので書式指定で高速パスを使う
+            # datetime64のまま保持し、日数計算や比較を列演算で行えるようにする
+            df[col] = pd.to_datetime(df[col], format='%Y-%m-%d', errors='coerce')
+    return df
+
+def clear_database_cache():
+    # DBに由来するキャッシュはまとめて破棄する (書込後に古い集計を残さない)
+    _load_frame.clear()
+    build_job_groups.clear()
+
 def get_database():
-    client = get_connection()
-    if not client: return pd.DataFrame()
-    try:
-        try:
-            sheet = client.open('battery_db').worksheet(NEW_SHEET_NAME)
-        except:
-            wb = client.open('battery_db')
-            sheet = wb.add_worksheet(title=NEW_SHEET_NAME, rows=1000, cols=10)
-            sheet.append_row(EXPECTED_HEADERS)
-
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        if df.empty: return pd.DataFrame(columns=EXPECTED_HEADERS)
-        
-        # カラム不足の補正
-        current_cols = df.columns.tolist()
-        if 'ジョブID' not in current_cols:
-            sheet.update_cell(1, len(current_cols) + 1, 'ジョブID')
-            df['ジョブID'] = ""
-
-        df['シリアルナンバー'] = df['シリアルナンバー'].astype(str)
-        if 'ステータス' in df.columns:
-            df['ステータス'] = df['ステータス'].astype(str).str.strip()
-        
-        df['金額'] = pd.to_numeric(df['金額'], errors='coerce').fillna(0).astype(int)
-        for col in ['保有開始日', '完了日']:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors='coerce').dt.date
-        return df
+    if not get_connection(): return pd.DataFrame()
+    try: return _load_frame()
     except: return pd.DataFrame()
 
 def get_active_inventory(df_all):
     if df_all.empty or 'ステータス' not in df_all.columns: return pd.DataFrame()
     df = df_all[df_all['ステータス'] == '在庫'].copy()
-    if not df.empty:
-        df = df.sort_values(by=['保有開始日'], ascending=[True])
-        return df
+    # 登録順に追記されるため大抵は日付順。整列済みならソート自体を省く
+    if not df.empty and not df['保有開始日'].is_monotonic_increasing:
+        df = df.sort_values(by='保有開始日', kind='mergesort')
     return df
 
+def calc_holding_days(start_dates, today):
+    # 保有日数を列ごと一括計算 (日付欠損はNaN)
+    return (pd.Timestamp(today) - start_dates).dt.days
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def build_job_groups(df_done):
+    # 完了済みをジョブ単位に集約。履歴が変わらない再実行ではキャッシュを返す
+    jobs = []
+    if df_done.empty:
+        return jobs
+    df_done = df_done.copy()
+    # JobIDのないものは空文字に置換
+    df_done['ジョブID'] = df_done['ジョブID'].fillna('')
+    # グルーピングキー作成: JobIDがあればそれ、なければ"NO-JOB-{完了日}"
+    # 行ごとのapplyを使わず列演算で作る (欠損日付は従来通り 'NaT' 表記)
+    df_done['完了日_str'] = df_done['完了日'].dt.strftime('%Y-%m-%d').fillna('NaT')
+    no_job_key = 'NO-JOB-' + df_done['完了日_str']
+    df_done['group_key'] = np.where(df_done['ジョブID'] != '', df_done['ジョブID'], no_job_key)
+
+    for key, group in df_done.groupby('group_key'):
+        first_row = group.iloc[0]
+        job_id = first_row['ジョブID']
+        date_val = first_row['完了日_str']
+
+        # ソート用ロジック:
+        # 1. JobIDがある (1) vs ない (0)
+        # 2. 値の大きさ（JobID文字列 or 日付文字列）
+        has_id = 1 if job_id else 0
+        sort_val = job_id if job_id else date_val
+
+        jobs.append({
+            'sort_key': (has_id, sort_val),
+            'job_id': job_id,
+            'date': date_val,
+            'area': first_row['エリア'],
+            'amount': group['金額'].sum(),
+            'count': len(group),
+            'sns': group['シリアルナンバー'].tolist()
+        })
+
+    # ソート: (JobID有無(1/0), 文字列) のタプルで降順ソート
+    # 結果: JobIDあり(最新順) -> JobIDなし(最新順) の順に並ぶ
+    jobs.sort(key=lambda x: x['sort_key'], reverse=True)
+    return jobs
+
+def summarize_week(df_done, today):
+    # 週次集計 (本数, 今週, 先週)。1列に対するマスク数本なので毎回計算する
+    start_of_week = today - datetime.timedelta(days=today.weekday())
+    last_week_start = start_of_week - datetime.timedelta(days=7)
+    
+    # NumPyのマスクで直接合計する (中間DataFrameを作らない)
+    comp_date = df_done['完了日'].values
+    amounts = df_done['金額'].values
+    week_start = np.datetime64(start_of_week)
+    
+    w_mask = comp_date >= week_start
+    lw_mask = (comp_date >= np.datetime64(last_week_start)) & (comp_date < week_start)
+    memo = df_done['備考']
+    # カテゴリごとに判定し、コード配列で各行へ展開 (欠損コード-1は末尾のFalseを引く)
+    bonus_cats = np.append(memo.cat.categories.str.contains('ボーナス', regex=False), False)
+    bonus_rows = bonus_cats[memo.cat.codes.values]
+
+    week_count = int((w_mask & ~bonus_rows).sum())
+    return week_count, int(amounts[w_mask].sum()), int(amounts[lw_mask].sum())
+
 def get_vol_bonus(count):
-    if count >= 150: return 20
-    elif count >= 100: return 15
-    elif count >= 50: return 10
-    elif count >= 20: return 5
-    else: return 0
+    return VOL_BONUS_VALUES[bisect.bisect_right(VOL_BONUS_THRESHOLDS, count)]
 
 # --- 分析モジュール (Analytics Logic V1.4) ---
 
@@ -230,53 +339,46 @@ def update_analytics_background():
     thread = threading.Thread(target=task)
     thread.start()
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def _read_analytics_cache(mtime):
+    with open(ANALYTICS_CACHE_FILE, 'r') as f:
+        return json.load(f)
+
 def load_analytics_cache():
     if not os.path.exists(ANALYTICS_CACHE_FILE):
         return None
     try:
-        with open(ANALYTICS_CACHE_FILE, 'r') as f:
-            return json.load(f)
+        # 更新時刻をキーにして、ファイルが書き換わった時だけ読み直す
+        return _read_analytics_cache(os.path.getmtime(ANALYTICS_CACHE_FILE))
     except:
         return None
 
 # --- 書き込み・計算ロジック ---
 
-def register_new_inventory(data_list):
-    client = get_connection()
-    sheet = client.open('battery_db').worksheet(NEW_SHEET_NAME)
-    all_records = sheet.get_all_records()
-    df = pd.DataFrame(all_records)
-    
-    current_active_serials = set()
-    if not df.empty and 'ステータス' in df.columns:
-        active_df = df[df['ステータス'].astype(str).str.strip().isin(['在庫', '出庫中'])]
-        current_active_serials = set(active_df['シリアルナンバー'].astype(str).tolist())
+def register_new_inventory(data_list, df_all):
+    sheet = get_sheet()
     
-    headers = sheet.row_values(1)
-    if not headers: sheet.append_row(EXPECTED_HEADERS)
+    # 重複判定は読込済みのdf_allで行う (シートの再ダウンロードはしない)
+    incoming = pd.Series([str(s) for s, _ in data_list], dtype=str)
+    exists = np.zeros(len(incoming), dtype=bool)
+    if not df_all.empty and 'ステータス' in df_all.columns:
+        active = df_all['ステータス'].isin(['在庫', '出庫中'])
+        exists = incoming.isin(df_all.loc[active, 'シリアルナンバー']).values
 
-    rows = []
-    skipped = 0
-    for s, d in data_list:
-        s_str = str(s)
-        if s_str in current_active_serials:
-            skipped += 1
-            continue
-        row = [sanitize_for_json(s_str), "在庫", sanitize_for_json(d), "", "", "", "", ""]
-        rows.append(row)
+    skipped = int(exists.sum())
+    rows = [[s, "在庫", sanitize_for_json(d), "", "", "", "", ""]
+            for s, (_, d), dup in zip(incoming, data_list, exists) if not dup]
     
     if rows:
         try: 
             sheet.append_rows(rows)
+            clear_database_cache()
             update_analytics_background()
         except: return 0, 0
     return len(rows), skipped
 
 def register_past_bulk(date_obj, count, total_amount, zone, memo="", job_id=""):
-    client = get_connection()
-    sheet = client.open('battery_db').worksheet(NEW_SHEET_NAME)
-    headers = sheet.row_values(1)
-    if not headers: sheet.append_row(EXPECTED_HEADERS)
+    sheet = get_sheet()
     if count <= 0: return 0
     
     base_amount = total_amount // count
@@ -290,65 +392,57 @@ def register_past_bulk(date_obj, count, total_amount, zone, memo="", job_id=""):
         rows.append(row)
     if rows: 
         sheet.append_rows(rows)
+        clear_database_cache()
         update_analytics_background()
 
     return len(rows)
 
-def recalc_weekly_revenue(sheet, today_date):
-    all_records = sheet.get_all_records()
-    headers = sheet.row_values(1)
-    try: col_price = headers.index('金額') + 1
-    except: return 0
+def rows_unchanged(sn_values, df, rows):
+    # 書込先の行に読込時と同じシリアルが残っているか (手作業の並べ替え・挿入・削除の検出)
+    expected = df['シリアルナンバー']
+    return all(r - 1 < len(sn_values) and sn_values[r - 1] == expected.at[r - 2] for r in rows)
 
+def recalc_weekly_revenue(sheet, today_date, df, col_price, sn_values):
+    # df は呼出元で今回の更新を反映済みのもの (再ダウンロードしない)
+    # sn_values は呼出元が書込直前に読み直したシリアル列
     start_of_week = today_date - datetime.timedelta(days=today_date.weekday())
     end_of_week = start_of_week + datetime.timedelta(days=6)
 
-    weekly_indices = []
-    for i, row in enumerate(all_records):
-        st_val = str(row.get('ステータス', '')).strip()
-        comp_date_str = str(row.get('完了日', ''))
-        memo = str(row.get('備考', ''))
-        
-        if st_val == '補充済' and comp_date_str and 'ボーナス' not in memo:
-            try:
-                comp_date = datetime.datetime.strptime(comp_date_str, '%Y-%m-%d').date()
-                if start_of_week <= comp_date <= end_of_week:
-                    weekly_indices.append(i)
-            except: pass
-
-    week_count = len(weekly_indices)
-    current_bonus = get_vol_bonus(week_count)
-    
-    cells_to_update = []
-    for idx in weekly_indices:
-        row = all_records[idx]
-        zone_name = str(row.get('エリア', ''))
-        base_price = ZONES.get(zone_name, 70)
-        start_d_str = str(row.get('保有開始日', ''))
-        end_d_str = str(row.get('完了日', ''))
-        early_bonus = 0
-        try:
-            s_date = datetime.datetime.strptime(start_d_str, '%Y-%m-%d').date()
-            e_date = datetime.datetime.strptime(end_d_str, '%Y-%m-%d').date()
-            if (e_date - s_date).days <= 3: early_bonus = 10
+    comp = df['完了日']
+    start = df['保有開始日']
+    mask = ((df['ステータス'] == '補充済')
+            & comp.between(pd.Timestamp(start_of_week), pd.Timestamp(end_of_week))
+            & ~df['備考'].str.contains('ボーナス', regex=False))
+
+    weekly = df[mask]
+    current_bonus = get_vol_bonus(len(weekly))
+
+    # 早期ボーナス: 保有3日以内なら+10 (開始日が読めない行は対象外)
+    early_bonus = np.where((comp[mask] - start[mask]).dt.days <= 3, 10, 0)
+    new_price = weekly['エリア'].map(ZONES).fillna(70).astype(int).values + current_bonus + early_bonus
+    changed = new_price != weekly['金額'].values
+
+    ranges = [{"range": rowcol_to_a1(i + 2, col_price), "values": [[int(p)]]}
+              for i, p in zip(weekly.index[changed], new_price[changed])]
+    if not rows_unchanged(sn_values, df, [i + 2 for i in weekly.index[changed]]):
+        clear_database_cache()
+        return 0
+    if ranges:
+        try: sheet.batch_update(ranges)
         except: pass
-        
-        new_total_price = base_price + current_bonus + early_bonus
-        if row.get('金額', 0) != new_total_price:
-            cells_to_update.append(gspread.Cell(idx + 2, col_price, new_total_price))
+        clear_database_cache()
+    return len(ranges)
 
-    if cells_to_update:
-        try: sheet.update_cells(cells_to_update)
-        except: pass
-    return len(cells_to_update)
-
-def update_status_bulk(target_serials, new_status, complete_date=None, zone="", price=0, memo="", job_id=""):
-    client = get_connection()
-    sheet = client.open('battery_db').worksheet(NEW_SHEET_NAME)
-    all_records = sheet.get_all_records()
-    headers = sheet.row_values(1)
+def update_status_bulk(target_serials, new_status, df_all, complete_date=None, zone="", price=0, memo="", job_id=""):
+    # 行の特定は読込済みの df_all で行う (シートを再取得しない)
+    # 行は削除しない運用のため シート行番号 = index + 2
+    target_set = set(str(s) for s in target_serials)
+    if not target_set: return {"error": False, "count": 0}
+    sheet = get_sheet()
+    headers = list(df_all.columns)
     
     try:
+        col_sn = headers.index('シリアルナンバー') + 1
         col_status = headers.index('ステータス') + 1
         col_end = headers.index('完了日') + 1
         col_zone = headers.index('エリア') + 1
@@ -357,56 +451,96 @@ def update_status_bulk(target_serials, new_status, complete_date=None, zone="",
         col_job = headers.index('ジョブID') + 1 if 'ジョブID' in headers else None
     except: return 0
 
-    cells = []
-    target_set = set(str(s) for s in target_serials)
+    permitted_statuses = ['在庫', '出庫中']
+    sn_col = df_all['シリアルナンバー']
+    hit = sn_col.isin(target_set)
+    # 検証は各SNの最新行(最終行)のステータスで行う
+    latest = df_all[hit].drop_duplicates('シリアルナンバー', keep='last')
     
     # --- Strict Validation ---
-    sn_status_map = {}
-    for row in all_records:
-        r_sn = str(row.get('シリアルナンバー', ''))
-        if r_sn in target_set:
-            sn_status_map[r_sn] = str(row.get('ステータス', '')).strip()
     
-    missing_sns = target_set - set(sn_status_map.keys())
+    missing_sns = target_set - set(latest['シリアルナンバー'])
     if missing_sns:
         return {"error": True, "msg": f"未登録のバッテリーが含まれています: {', '.join(missing_sns)}"}
     
-    permitted_statuses = ['在庫', '出庫中']
-    invalid_sns = []
-    for sn, st_val in sn_status_map.items():
-        if st_val not in permitted_statuses:
-            invalid_sns.append(f"{sn}({st_val})")
-            
-    if invalid_sns:
+    invalid = latest[~latest['ステータス'].isin(permitted_statuses)]
+    if not invalid.empty:
+        invalid_sns = [f"{sn}({st_val})" for sn, st_val in zip(invalid['シリアルナンバー'], invalid['ステータス'])]
         return {"error": True, "msg": f"対象外ステータスのバッテリーが含まれています: {', '.join(invalid_sns)}"}
 
+    # 更新対象は在庫/出庫中の行のみ (同じSNの過去の完了履歴は書き換えない)
+    target_rows = (df_all.index[hit & df_all['ステータス'].isin(permitted_statuses)] + 2).tolist()
+
+    # 行番号はキャッシュ由来のため、書込前にシリアル列だけ読み直して行ずれがないか確認する
+    try: sn_values = sheet.col_values(col_sn)
+    except: return {"error": True, "msg": "DB読込エラー"}
+    if not rows_unchanged(sn_values, df_all, target_rows):
+        clear_database_cache()
+        return {"error": True, "msg": "シートの行位置が読込時から変わっています。最新データで再実行してください"}
+
     comp_str = sanitize_for_json(complete_date)
     safe_price = int(price)
 
-    updated = 0
-    for i, row in enumerate(all_records):
-        s = str(row.get('シリアルナンバー', ''))
-        if s in target_set:
-            r = i + 2
-            cells.append(gspread.Cell(r, col_status, new_status))
-            cells.append(gspread.Cell(r, col_end, comp_str))
-            cells.append(gspread.Cell(r, col_zone, zone))
-            cells.append(gspread.Cell(r, col_price, safe_price))
-            if memo: cells.append(gspread.Cell(r, col_memo, memo))
-            if col_job and job_id: cells.append(gspread.Cell(r, col_job, job_id))
-            updated += 1
-            
-    if cells:
-        try: sheet.update_cells(cells)
+    # 書込む列 -> 値。隣接する列は1つのA1レンジにまとめて送る
+    write_cols = {col_status: new_status, col_end: comp_str, col_zone: zone, col_price: safe_price}
+    if memo: write_cols[col_memo] = memo
+    if col_job and job_id: write_cols[col_job] = job_id
+    spans = []
+    for c in sorted(write_cols):
+        if spans and spans[-1][-1] == c - 1: spans[-1].append(c)
+        else: spans.append([c])
+
+    ranges = []
+    for r in target_rows:
+        for span in spans:
+            ranges.append({
+                "range": f"{rowcol_to_a1(r, span[0])}:{rowcol_to_a1(r, span[-1])}",
+                "values": [[write_cols[c] for c in span]]
+            })
+    updated_idx = [r - 2 for r in target_rows]
+
+    if ranges:
+        try: sheet.batch_update(ranges)
         except: return {"error": True, "msg": "DB更新エラー"}
+        clear_database_cache()
     
-    if updated > 0 and new_status == '補充済' and complete_date:
-        recalc_weekly_revenue(sheet, complete_date)
+    if updated_idx and new_status == '補充済' and complete_date:
+        # 週次再計算用に、今回の書込内容を反映した作業用の表を作る
+        df = df_all[['シリアルナンバー', 'ステータス', '保有開始日', '完了日', 'エリア', '金額']].copy()
+        df['備考'] = df_all['備考'].astype(str)
+        df.loc[updated_idx, 'ステータス'] = new_status
+        df.loc[updated_idx, '完了日'] = pd.Timestamp(complete_date)
+        df.loc[updated_idx, 'エリア'] = zone
+        df.loc[updated_idx, '金額'] = safe_price
+        if memo: df.loc[updated_idx, '備考'] = memo
+        recalc_weekly_revenue(sheet, complete_date, df, col_price, sn_values)
         update_analytics_background()
 
-    return {"error": False, "count": updated}
+    return {"error": False, "count": len(updated_idx)}
 
 # --- UIパーツ ---
+# カードHTMLはモジュール読込時に1度だけ用意し、描画時は差し込みのみ行う
+CARD_TEMPLATE = """<div style="background:{bg}; border-radius:8px; border-left:6px solid {bd}; padding:10px; margin-bottom:8px; box-shadow:0 1px 3px rgba(0,0,0,0.1);">
+<div style="display:flex; justify-content:space-between; font-size:11px; font-weight:bold; color:{c};">
+<div>{st_t}</div><div>{date_label}</div>
+</div>
+<div style="font-size:28px; font-weight:900; color:#212121; margin-top:2px; letter-spacing:1px;">{main_text}</div>
+<div style="text-align:right; font-size:9px; color:#999; font-family:monospace;">{sn}</div>
+</div>"""
+
+JOB_CARD_TEMPLATE = """<div style="background:#ffffff; border:1px solid #e0e0e0; border-radius:8px; padding:12px; margin-bottom:5px; border-left: 5px solid #1565c0;">
+<div style="display:flex; justify-content:space-between; align-items:center;">
+<div>
+<div style="font-size:12px; color:#757575; font-weight:bold;">{date} | {area}</div>
+<div style="font-size:16px; color:#212121; font-weight:bold;">{label}</div>
+</div>
+<div style="text-align:right;">
+<div style="font-size:20px; font-weight:900; color:#1565c0;">¥{amount:,}</div>
+<div style="font-size:11px; color:#757575;">{count}本</div>
+</div>
+</div>
+</div>"""
+
 def create_card(row, today):
     start_date = row.get('保有開始日')
     status = str(row.get('ステータス', '')).strip()
@@ -416,8 +550,9 @@ def create_card(row, today):
     if pd.isnull(start_date):
         s_str, days = "-", 0
     else:
-        s_str = start_date.strftime('%m/%d')
-        days = (today - start_date).days
+        s_str = row.get('start_label') or start_date.strftime('%m/%d')
+        days = row.get('days_held')
+        days = int(days) if pd.notnull(days) else (pd.Timestamp(today) - start_date).days
     
     if status == '補充済':
         c, bg, st_t, bd = "#1565c0", "#e3f2fd", "✅ 完了", "#2196f3"
@@ -442,16 +577,71 @@ def create_card(row, today):
         date_label = f"取得: {s_str}"
         main_text = last4
 
-    html = f"""
-    <div style="background:{bg}; border-radius:8px; border-left:6px solid {bd}; padding:10px; margin-bottom:8px; box-shadow:0 1px 3px rgba(0,0,0,0.1);">
-        <div style="display:flex; justify-content:space-between; font-size:11px; font-weight:bold; color:{c};">
-            <div>{st_t}</div><div>{date_label}</div>
-        </div>
-        <div style="font-size:28px; font-weight:900; color:#212121; margin-top:2px; letter-spacing:1px;">{main_text}</div>
-        <div style="text-align:right; font-size:9px; color:#999; font-family:monospace;">{sn}</div>
-    </div>
-    """
-    return html
+    return CARD_TEMPLATE.format(c=c, bg=bg, st_t=st_t, bd=bd, date_label=date_label, main_text=main_text, sn=sn)
+
+# 表示数スライダー等の操作ではこの部分だけ再実行する (シート取得・集計を含む全体再実行を避ける)
+@st.fragment
+def render_pickup(df_inv, today):
+    st.markdown("##### 📌 ピックアップ (優先順)")
+    col_sl, _ = st.columns([1,2])
+    with col_sl:
+        disp_count = st.slider("表示数", 4, 40, 8, step=4)
+
+    if not df_inv.empty:
+        days = df_inv['days_held'].values
+        rank = np.select([days >= (PENALTY_LIMIT_DAYS - 5), days <= 3], [1, 2], default=3)
+        # df_invは保有開始日で安定ソート済みのため、rankの安定argsort1回で (rank, 保有開始日) 順になる
+        # 全件コピーはせず、表示する上位N行だけを取り出す
+        order = np.argsort(rank, kind='stable')[:disp_count]
+        top_n = df_inv.iloc[order]
+        cards = [create_card(row, today) for row in top_n.to_dict('records')]
+        # 列ごとにカードを連結して1回で描画 (カード毎のst.markdownを避ける)
+        cols = st.columns(4)
+        for j, col in enumerate(cols):
+            if cards[j::4]:
+                col.markdown("\n".join(cards[j::4]), unsafe_allow_html=True)
+    else: st.info("現在、在庫はありません")
+
+@st.fragment
+def render_search(df_inv, df_all, today):
+    date_options = ["指定なし"]
+    date_map = {}
+    if not df_inv.empty:
+        unique_dates = df_inv['保有開始日'].dropna().drop_duplicates().sort_values(ascending=False)
+        labels = unique_dates.dt.strftime('%m/%d').tolist()
+        date_options += labels
+        date_map.update(zip(labels, unique_dates))
+
+    c_s1, c_s2 = st.columns(2)
+    with c_s1:
+        sel_date = st.selectbox("保有開始日 (在庫のみ)", date_options)
+    with c_s2:
+        sn_in = st.number_input("SN下4桁", 0, 9999, 0)
+
+    results = pd.DataFrame()
+
+    if sel_date != "指定なし":
+        target_date = date_map[sel_date]
+        results = df_inv[df_inv['保有開始日'] == target_date].copy()
+        if sn_in > 0:
+            results = results[results['シリアルナンバー'].str.endswith(str(sn_in))]
+
+        if not results.empty:
+            st.success(f"{len(results)}件 (保有日: {sel_date})")
+            st.markdown("\n".join(create_card(row, today) for row in results.to_dict('records')), unsafe_allow_html=True)
+        else:
+            st.warning("該当なし")
+
+    elif sn_in > 0:
+        if not df_all.empty:
+            results = df_all[df_all['シリアルナンバー'].str.endswith(str(sn_in))]
+            if not results.empty:
+                st.success(f"{len(results)}件 ヒット (全期間)")
+                st.markdown("\n".join(create_card(row, today) for row in results.to_dict('records')), unsafe_allow_html=True)
+            else:
+                st.warning("なし")
+    else:
+        st.info("条件を指定してください")
 
 # --- メイン ---
 def main():
@@ -463,52 +653,31 @@ def main():
     st.markdown("<style>.stSlider{padding-top:1rem;}</style>", unsafe_allow_html=True)
     today = get_today_jst()
 
-    if 'stocktake_buffer' not in st.session_state: st.session_state['stocktake_buffer'] = []
+    if 'stocktake_buffer' not in st.session_state: st.session_state['stocktake_buffer'] = {}
     if 'parsed_data' not in st.session_state: st.session_state['parsed_data'] = None
 
+    # 他端末での更新を即時に反映したい時用 (通常はDB_CACHE_TTLで自動更新)
+    if st.button("🔄 最新データを取得"):
+        clear_database_cache()
+
     df_all = get_database()
     
     if not df_all.empty and 'ステータス' in df_all.columns:
-        df_valid = df_all[~df_all['ステータス'].str.contains('削除', na=False)]
-        df_inv = get_active_inventory(df_valid)
-        df_hist = df_valid[df_valid['ステータス'] != '在庫'].copy()
+        # 在庫/補充済は完全一致で切り出すため '削除' を含む行は自然に外れる (部分一致での全行走査は不要)
+        df_inv = get_active_inventory(df_all)
+        if not df_inv.empty:
+            df_inv['days_held'] = calc_holding_days(df_inv['保有開始日'], today)
+            df_inv['start_label'] = df_inv['保有開始日'].dt.strftime('%m/%d')
+        # 履歴側で使うのは補充済みのみ。ここで一度だけ絞り込み、週次集計と収益タブで共用する
+        df_done = df_all[df_all['ステータス'] == '補充済']
     else:
         df_inv = pd.DataFrame()
-        df_hist = pd.DataFrame()
+        df_done = pd.DataFrame()
 
-    week_earnings = 0
-    last_week_earnings = 0
-    week_count = 0
-    next_bonus_at = 20
-    
-    if not df_hist.empty:
-        start_of_week = today - datetime.timedelta(days=today.weekday())
-        last_week_start = start_of_week - datetime.timedelta(days=7)
-        
-        df_hist['comp_date'] = pd.to_datetime(df_hist['完了日'], errors='coerce')
-        
-        w_df = df_hist[
-            (df_hist['comp_date'].dt.date >= start_of_week) & 
-            (df_hist['ステータス'] == '補充済')
-        ].copy()
-        
-        lw_df = df_hist[
-            (df_hist['comp_date'].dt.date >= last_week_start) & 
-            (df_hist['comp_date'].dt.date < start_of_week) & 
-            (df_hist['ステータス'] == '補充済')
-        ].copy()
-
-        count_mask = w_df.apply(lambda x: 'ボーナス' not in str(x['備考']), axis=1)
-        week_count = len(w_df[count_mask])
-        week_earnings = int(w_df['金額'].sum())
-        last_week_earnings = int(lw_df['金額'].sum())
-        
-        if week_count < 20: next_bonus_at = 20
-        elif week_count < 50: next_bonus_at = 50
-        elif week_count < 100: next_bonus_at = 100
-        elif week_count < 150: next_bonus_at = 150
-        else: next_bonus_at = 999
+    week_count, week_earnings, last_week_earnings = summarize_week(df_done, today) if not df_done.empty else (0, 0, 0)
 
+    # 次の閾値 (最上位到達後は999)
+    next_bonus_at = (VOL_BONUS_THRESHOLDS + (999,))[bisect.bisect_right(VOL_BONUS_THRESHOLDS, week_count)]
     cur_bonus = get_vol_bonus(week_count)
 
     if next_bonus_at != 999:
@@ -543,7 +712,7 @@ def main():
             if st.session_state['parsed_data']:
                 st.dataframe(pd.DataFrame(st.session_state['parsed_data'], columns=["SN","日付"]), hide_index=True)
                 if st.button("登録実行", type="primary", use_container_width=True):
-                    cnt, skip = register_new_inventory(st.session_state['parsed_data'])
+                    cnt, skip = register_new_inventory(st.session_state['parsed_data'], df_all)
                     msg = f"✅ {cnt}件 登録"
                     if skip > 0: msg += f" (手元重複 {skip}件 スキップ)"
                     st.success(msg)
@@ -566,7 +735,7 @@ def main():
                         now_str = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
                         auto_job_id = f"J{now_str}"
                         
-                        res = update_status_bulk(sns, "補充済", date_done, zone, base, job_id=auto_job_id)
+                        res = update_status_bulk(sns, "補充済", df_all, date_done, zone, base, job_id=auto_job_id)
                         if isinstance(res, dict) and res.get('error'):
                             st.error(f"⛔️ エラー: {res['msg']}")
                         else:
@@ -576,80 +745,19 @@ def main():
                             st.rerun()
 
         st.divider()
-        st.markdown("##### 📌 ピックアップ (優先順)")
-        col_sl, _ = st.columns([1,2])
-        with col_sl:
-            disp_count = st.slider("表示数", 4, 40, 8, step=4)
-
-        if not df_inv.empty:
-            df_disp = df_inv.copy()
-            def get_priority(row):
-                days = (today - row['保有開始日']).days
-                if days >= (PENALTY_LIMIT_DAYS - 5): return 1
-                if days <= 3: return 2
-                return 3
-            df_disp['rank'] = df_disp.apply(get_priority, axis=1)
-            df_disp = df_disp.sort_values(by=['rank', '保有開始日'], ascending=[True, True])
-            
-            top_n = df_disp.head(disp_count)
-            for i in range(0, len(top_n), 4):
-                cols = st.columns(4)
-                chunk = top_n.iloc[i:i+4]
-                for j, (_, row) in enumerate(chunk.iterrows()):
-                    with cols[j]:
-                        st.markdown(create_card(row, today), unsafe_allow_html=True)
-        else: st.info("現在、在庫はありません")
+        render_pickup(df_inv, today)
 
     # 2. 検索
     with tab2:
-        date_options = ["指定なし"]
-        date_map = {}
-        if not df_inv.empty:
-            unique_dates = sorted(df_inv['保有開始日'].unique(), reverse=True)
-            for d in unique_dates:
-                if pd.notnull(d):
-                    label = d.strftime('%m/%d')
-                    date_options.append(label)
-                    date_map[label] = d
-
-        c_s1, c_s2 = st.columns(2)
-        with c_s1:
-            sel_date = st.selectbox("保有開始日 (在庫のみ)", date_options)
-        with c_s2:
-            sn_in = st.number_input("SN下4桁", 0, 9999, 0)
-
-        results = pd.DataFrame()
-        
-        if sel_date != "指定なし":
-            target_date = date_map[sel_date]
-            results = df_inv[df_inv['保有開始日'] == target_date].copy()
-            if sn_in > 0:
-                results = results[results['シリアルナンバー'].str.endswith(str(sn_in))]
-            
-            if not results.empty:
-                st.success(f"{len(results)}件 (保有日: {sel_date})")
-                for _, row in results.iterrows():
-                    st.markdown(create_card(row, today), unsafe_allow_html=True)
-            else:
-                st.warning("該当なし")
-
-        elif sn_in > 0:
-            if not df_all.empty:
-                results = df_all[df_all['シリアルナンバー'].str.endswith(str(sn_in))]
-                if not results.empty:
-                    st.success(f"{len(results)}件 ヒット (全期間)")
-                    for _, row in results.iterrows():
-                        st.markdown(create_card(row, today), unsafe_allow_html=True)
-                else:
-                    st.warning("なし")
-        else:
-            st.info("条件を指定してください")
+        render_search(df_inv, df_all, today)
 
     # 3. 在庫
     with tab3:
         st.metric("在庫数", f"{len(df_inv)}")
         if not df_inv.empty:
-            st.dataframe(df_inv[['保有開始日', 'シリアルナンバー']], use_container_width=True)
+            df_disp = df_inv[['保有開始日', 'シリアルナンバー']].copy()
+            df_disp['保有開始日'] = df_disp['保有開始日'].dt.strftime('%Y-%m-%d')
+            st.dataframe(df_disp, use_container_width=True)
 
     # 4. 収益
     with tab4:
@@ -675,65 +783,12 @@ def main():
         st.divider()
         st.subheader("📊 履歴タイムライン (Job Group View)")
 
-        if not df_hist.empty:
-            df_done = df_hist[df_hist['ステータス'] == '補充済'].copy()
-            if not df_done.empty:
-                # JobIDのないものは空文字に置換
-                df_done['ジョブID'] = df_done['ジョブID'].fillna('')
-                # グルーピングキー作成: JobIDがあればそれ、なければ"NO-JOB-{完了日}"
-                df_done['group_key'] = df_done.apply(lambda x: x['ジョブID'] if x['ジョブID'] else f"NO-JOB-{x['完了日']}", axis=1)
-                
-                jobs = []
-                grouped = df_done.groupby('group_key')
-                
-                for key, group in grouped:
-                    first_row = group.iloc[0]
-                    job_id = first_row['ジョブID']
-                    date_val = str(first_row['完了日'])
-                    area_val = first_row['エリア']
-                    total_amt = group['金額'].sum()
-                    count = len(group)
-                    sn_list = group['シリアルナンバー'].tolist()
-                    
-                    # ソート用ロジック:
-                    # 1. JobIDがある (1) vs ない (0)
-                    # 2. 値の大きさ（JobID文字列 or 日付文字列）
-                    has_id = 1 if job_id else 0
-                    sort_val = job_id if job_id else date_val
-                    
-                    jobs.append({
-                        'sort_key': (has_id, sort_val),
-                        'job_id': job_id,
-                        'date': date_val,
-                        'area': area_val,
-                        'amount': total_amt,
-                        'count': count,
-                        'sns': sn_list
-                    })
-                
-                # ソート: (JobID有無(1/0), 文字列) のタプルで降順ソート
-                # 結果: JobIDあり(最新順) -> JobIDなし(最新順) の順に並ぶ
-                jobs.sort(key=lambda x: x['sort_key'], reverse=True)
-                
-                for j in jobs:
-                    job_label = j['job_id'] if j['job_id'] else "Legacy Job (No ID)"
-                    card_html = f"""
-                    <div style="background:#ffffff; border:1px solid #e0e0e0; border-radius:8px; padding:12px; margin-bottom:5px; border-left: 5px solid #1565c0;">
-                        <div style="display:flex; justify-content:space-between; align-items:center;">
-                            <div>
-                                <div style="font-size:12px; color:#757575; font-weight:bold;">{j['date']} | {j['area']}</div>
-                                <div style="font-size:16px; color:#212121; font-weight:bold;">{job_label}</div>
-                            </div>
-                            <div style="text-align:right;">
-                                <div style="font-size:20px; font-weight:900; color:#1565c0;">¥{j['amount']:,}</div>
-                                <div style="font-size:11px; color:#757575;">{j['count']}本</div>
-                            </div>
-                        </div>
-                    </div>
-                    """
-                    st.markdown(card_html, unsafe_allow_html=True)
-                    with st.expander(f"詳細を見る ({len(j['sns'])}本)"):
-                        st.write(", ".join(j['sns']))
+        if not df_done.empty:
+            for j in build_job_groups(df_done):
+                job_label = j['job_id'] if j['job_id'] else "Legacy Job (No ID)"
+                st.markdown(JOB_CARD_TEMPLATE.format(label=job_label, **j), unsafe_allow_html=True)
+                with st.expander(f"詳細を見る ({len(j['sns'])}本)"):
+                    st.write(", ".join(j['sns']))
 
     # 5. 棚卸
     with tab5:
@@ -744,35 +799,30 @@ def main():
             txt_stock = st.text_area("全リスト貼付")
             if st.button("リストを読込"):
                 if txt_stock:
-                    add = extract_serials_with_date(txt_stock, today)
-                    st.session_state['stocktake_buffer'] = add
+                    # SN -> 日付 の辞書で保持 (照合時に変換し直さない)
+                    st.session_state['stocktake_buffer'] = dict(extract_serials_with_date(txt_stock, today))
                     st.rerun()
             if st.button("クリア"):
-                st.session_state['stocktake_buffer'] = []
+                st.session_state['stocktake_buffer'] = {}
                 st.rerun()
         with c2:
             st.caption(f"読込: {len(cur)}件")
-            if cur: st.dataframe(pd.DataFrame(cur, columns=["SN","日付"]), height=150, hide_index=True)
+            if cur: st.dataframe(pd.DataFrame(list(cur.items()), columns=["SN","日付"]), height=150, hide_index=True)
 
         st.divider()
         if cur:
-            s_map = {s:d for s,d in cur}
-            input_set = set(s_map.keys())
-            db_map = {}
-            if not df_inv.empty:
-                db_map = dict(zip(df_inv['シリアルナンバー'], df_inv['保有開始日']))
-            db_set = set(db_map.keys())
-            missing_db = []
-            for s, d in s_map.items():
-                if s not in db_map: missing_db.append((s, d))
-            ghosts = list(db_set - input_set)
+            s_map = cur
+            db_set = set(df_inv['シリアルナンバー']) if not df_inv.empty else set()
+            # 在庫側は集合にして所属判定のみ行う。新規分は貼付順のまま登録する
+            missing_db = [(s, d) for s, d in s_map.items() if s not in db_set]
+            ghosts = list(db_set - s_map.keys())
             
             c_act1, c_act2 = st.columns(2)
             with c_act1:
                 st.markdown(f"**① 新規在庫: {len(missing_db)}件**")
                 if missing_db:
                     if st.button("新規分を登録", type="primary"):
-                        cnt, _ = register_new_inventory(missing_db)
+                        cnt, _ = register_new_inventory(missing_db, df_all)
                         st.success(f"{cnt}件 登録しました")
                         time.sleep(1)
                         st.rerun()
@@ -782,7 +832,7 @@ def main():
                     st.warning("在庫差異あり")
                     with st.expander("詳細"): st.write(ghosts)
                     if st.button("一括「補充エラー」にする"):
-                        res = update_status_bulk(ghosts, "補充エラー", today, "", 0, "棚卸検知")
+                        res = update_status_bulk(ghosts, "補充エラー", df_all, today, "", 0, "棚卸検知")
                         if isinstance(res, dict) and res.get('error'):
                             st.error(res['msg'])
                         else:
@@ -870,9 +920,10 @@ def main():
             raw_days = analytics_data.get('histogram_raw', [])
             if raw_days:
                 hist_source = pd.DataFrame({'days': raw_days})
-                hist_source['zone'] = hist_source['days'].apply(
-                    lambda x: 'A(0-3)' if x <= 3 else ('B(4-22)' if x <= 22 else 'C(23+)')
-                )
+                # ゾーン分けは区間指定で一括 (0-3 / 4-22 / 23+)
+                hist_source['zone'] = pd.cut(
+                    hist_source['days'], bins=[-np.inf, 3, 22, np.inf], labels=['A(0-3)', 'B(4-22)', 'C(23+)']
+                ).astype(str)
 
                 base = alt.Chart(hist_source).encode(x=alt.X('days', title='保有日数', bin=alt.Bin(maxbins=30)))
 